@@ -1,24 +1,45 @@
 import configparser
-from datetime import datetime
-import os
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.types import *
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, monotonically_increasing_id, weekofyear, dayofweek
+from pyspark.sql.functions import col, broadcast, concat_ws, sha2
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 
 config = configparser.ConfigParser()
 config.read('dl.cfg')
 
-# If we are running spark locally we need the AWS Access Key ID and AWS Secret Access Key to access S3
-# If we are running spark in the AWS EMR cluster this is not required
-try:
-    os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
-    os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
-except:
-    print("Could not set OS environment")
+# Explicit schemas for the raw json files, so spark does not need an extra pass over the data to infer them
+SONG_SCHEMA = StructType([
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("artist_id", StringType()),
+    StructField("artist_name", StringType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("duration", DoubleType()),
+    StructField("year", IntegerType()),
+    StructField("num_songs", IntegerType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField("ts", LongType()),
+    StructField("page", StringType()),
+    StructField("userId", StringType()),
+    StructField("firstName", StringType()),
+    StructField("lastName", StringType()),
+    StructField("gender", StringType()),
+    StructField("level", StringType()),
+    StructField("song", StringType()),
+    StructField("artist", StringType()),
+    StructField("sessionId", LongType()),
+    StructField("location", StringType()),
+    StructField("userAgent", StringType())
+])
 
 
 def create_spark_session():
@@ -27,10 +48,37 @@ def create_spark_session():
     :return: SparkSession
     """
     logging.info("Creating spark session")
-    spark = SparkSession \
+    builder = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .config("spark.sql.autoBroadcastJoinThreshold", 128 * 1024 * 1024) \
+        .config("spark.sql.parquet.enableVectorizedReader", "true") \
+        .config("spark.sql.parquet.filterPushdown", "true") \
+        .config("spark.sql.parquet.mergeSchema", "false") \
+        .config("spark.sql.parquet.compression.codec", "snappy") \
+        .config("spark.sql.parquet.columnarReaderBatchSize", "8192") \
+        .config("spark.sql.files.maxPartitionBytes", 128 * 1024 * 1024) \
+        .config("spark.sql.shuffle.partitions", "64") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64MB") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.hadoop.fs.s3a.connection.maximum", "200") \
+        .config("spark.hadoop.fs.s3a.threads.max", "64") \
+        .config("spark.hadoop.fs.s3a.multipart.size", 64 * 1024 * 1024) \
+        .config("spark.hadoop.fs.s3a.multipart.threshold", 128 * 1024 * 1024)
+
+    # If we are running spark locally we need the AWS Access Key ID and AWS Secret Access Key to access S3
+    # If we are running spark in the AWS EMR cluster this is not required
+    # The keys are passed straight to the s3a client, so they are not exposed in the environment of the workers
+    aws_access_key_id = config.get('AWS', 'AWS_ACCESS_KEY_ID', fallback='')
+    aws_secret_access_key = config.get('AWS', 'AWS_SECRET_ACCESS_KEY', fallback='')
+    if aws_access_key_id and aws_secret_access_key:
+        builder = builder \
+            .config("spark.hadoop.fs.s3a.access.key", aws_access_key_id) \
+            .config("spark.hadoop.fs.s3a.secret.key", aws_secret_access_key)
+
+    spark = builder.getOrCreate()
     return spark
 
 
@@ -42,7 +90,7 @@ def load_song_data(spark, input_song_data_path):
     :return: song dataframe
     """
     logging.info("Load song data")
-    return spark.read.json(input_song_data_path)
+    return spark.read.schema(SONG_SCHEMA).json(input_song_data_path)
 
 
 def load_log_data(spark, input_log_data_path):
@@ -53,22 +101,32 @@ def load_log_data(spark, input_log_data_path):
     :return: log dataframe
     """
     logging.info("Load log data")
-    return spark.read.json(input_log_data_path)
+    # rename the columns to the snake_case names used by the analytics tables once, right after loading
+    return spark.read.schema(LOG_SCHEMA).json(input_log_data_path) \
+        .toDF("ts", "page", "user_id", "first_name", "last_name", "gender", "level", "song", "artist", "session_id",
+              "location", "user_agent")
 
 
 def preprocess_log_data(log_data):
     """
-    Filter log data which action is viewing a song, and convert ts to timestamp
+    Filter log data which action is viewing a song, convert ts to timestamp and derive its year and month
     :param log_data: log dataframe
     :return: processed log dataframe
     """
     logging.info("Preprocess log data")
     # filter for page=NextSong only
-    log_data = log_data.filter(log_data.page == "NextSong")
+    log_data = log_data.filter(col("page") == "NextSong")
+
+    # keep only the columns required by the users, time and songplays tables
+    log_data = log_data.select("ts", "user_id", "first_name", "last_name", "gender", "level", "song", "artist",
+                               "session_id", "location", "user_agent")
 
     # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: datetime.fromtimestamp(x / 1000.0), TimestampType())
-    log_data = log_data.withColumn("timestamp", get_timestamp("ts"))
+    # ts is in milliseconds, a built-in cast keeps this inside the JVM instead of a python udf
+    log_data = log_data.withColumn("timestamp", (col("ts") / 1000).cast(TimestampType()))
+
+    # year and month are used by both the time and songplays tables, derive them once here
+    log_data = log_data.withColumn("year", year("timestamp")).withColumn("month", month("timestamp"))
 
     return log_data
 
@@ -85,7 +143,9 @@ def process_song_table(song_data, output_data_path):
     songs_table = song_data.dropDuplicates(['song_id']).select("song_id", "title", "artist_id", "duration", "year")
 
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_id").mode("overwrite").parquet(
+    # repartition by the same columns first, so each output partition is written by a single task
+    songs_table.repartition("year", "artist_id").sortWithinPartitions("year", "artist_id") \
+        .write.partitionBy("year", "artist_id").mode("overwrite").parquet(
         f"{output_data_path}/songs_table.parquet")
 
 
@@ -97,14 +157,14 @@ def process_artist_table(song_data, output_data_path):
     :return: None
     """
     logging.info("Process artists table")
-    # extract columns to create artists table
-    artists_table = song_data.dropDuplicates(['artist_id']).select("artist_id", col("artist_name").alias("name"),
-                                                                   col("artist_location").alias("location"),
-                                                                   col("artist_latitude").alias("latitude"),
-                                                                   col("artist_longitude").alias("longitude"))
+    # extract columns to create artists table, projecting before deduplicating so less data is shuffled
+    artists_table = song_data.select("artist_id", col("artist_name").alias("name"),
+                                     col("artist_location").alias("location"),
+                                     col("artist_latitude").alias("latitude"),
+                                     col("artist_longitude").alias("longitude")).dropDuplicates(['artist_id'])
 
-    # write artists table to parquet files
-    artists_table.write.mode("overwrite").parquet(f"{output_data_path}/artists_table.parquet")
+    # write artists table to parquet files, the table is small so a single file is enough
+    artists_table.coalesce(1).write.mode("overwrite").parquet(f"{output_data_path}/artists_table.parquet")
 
 
 def process_users_table(log_data, output_data_path):
@@ -115,13 +175,11 @@ def process_users_table(log_data, output_data_path):
     :return: None
     """
     logging.info("Process users table")
-    # extract columns for users table
-    users_table = log_data.dropDuplicates(["userId"]).select(col("userId").alias("user_id"),
-                                                             col("firstName").alias("first_name"),
-                                                             col("lastName").alias("last_name"), "gender", "level")
+    # extract columns for users table, projecting before deduplicating so less data is shuffled
+    users_table = log_data.select("user_id", "first_name", "last_name", "gender", "level").dropDuplicates(["user_id"])
 
-    # write users table to parquet files
-    users_table.write.mode("overwrite").parquet(f"{output_data_path}/users_table.parquet")
+    # write users table to parquet files, the table is small so a single file is enough
+    users_table.coalesce(1).write.mode("overwrite").parquet(f"{output_data_path}/users_table.parquet")
 
 
 def process_time_table(log_data, output_data_path):
@@ -132,40 +190,51 @@ def process_time_table(log_data, output_data_path):
     :return: None
     """
     logging.info("Process time table")
+    # deduplicate the start times first, so the date parts are only computed once per distinct start time
+    start_times = log_data.select(col("timestamp").alias("start_time"), "year", "month") \
+        .dropDuplicates(["start_time"])
+
     # extract columns to create time table
-    time_table = log_data.dropDuplicates(["ts"]).select(col("timestamp").alias("start_time"),
-                                                        hour("timestamp").alias("hour"),
-                                                        dayofmonth("timestamp").alias("day"),
-                                                        weekofyear("timestamp").alias("week"),
-                                                        month("timestamp").alias("month"),
-                                                        year("timestamp").alias("year"),
-                                                        dayofweek("timestamp").alias("weekday"))
+    time_table = start_times.select("start_time",
+                                    hour("start_time").alias("hour"),
+                                    dayofmonth("start_time").alias("day"),
+                                    weekofyear("start_time").alias("week"),
+                                    "month",
+                                    "year",
+                                    dayofweek("start_time").alias("weekday"))
 
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year", "month").mode("overwrite").parquet(f"{output_data_path}/time_table.parquet")
+    # repartition by the same columns first, so each output partition is written by a single task
+    time_table.repartition("year", "month").write.partitionBy("year", "month").mode("overwrite").parquet(
+        f"{output_data_path}/time_table.parquet")
 
 
-def process_songplays_table(song_data, log_data, output_data_path):
+def process_songplays_table(song_join, log_data, output_data_path):
     """
     Create songplays table and write it to the output_data_path
-    :param song_data: song dataframe
+    :param song_join: song dataframe with the song_id, title, artist_id and artist_name columns
     :param log_data: log dataframe
     :param output_data_path: output path to store the songplays table
     :return: None
     """
     logging.info("Process songplays table")
+    # the song catalog is much smaller than the logs, so broadcast it instead of shuffling the logs
+    song_join = broadcast(song_join)
+
+    # derive songplay_id from the columns identifying a play, so reprocessing the same logs gives the same ids
+    songplay_id = sha2(concat_ws('|', 'user_id', 'session_id', 'ts'), 256)
+
     # extract columns from joined song and log datasets to create songplays table
-    songplays_table = log_data.join(song_data, (log_data.song == song_data.title) & (
-            log_data.artist == song_data.artist_name)).select(monotonically_increasing_id().alias('songplay_id'),
+    songplays_table = log_data.join(song_join, (log_data.song == song_join.title) & (
+            log_data.artist == song_join.artist_name)).select(songplay_id.alias('songplay_id'),
                                                               col('timestamp').alias('start_time'),
-                                                              year('timestamp').alias('year'),
-                                                              month('timestamp').alias('month'),
-                                                              col('userId').alias('user_id'), 'level', 'song_id',
-                                                              'artist_id', col('sessionId').alias('session_id'),
-                                                              'location', col('userAgent').alias('user_agent'))
+                                                              'year', 'month',
+                                                              'user_id', 'level', 'song_id', 'artist_id',
+                                                              'session_id', 'location', 'user_agent')
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy("year", "month").mode("overwrite").parquet(
+    # repartition by the same columns first, so each output partition is written by a single task
+    songplays_table.repartition("year", "month").write.partitionBy("year", "month").mode("overwrite").parquet(
         f"{output_data_path}/songplays_table.parquet")
 
 
@@ -193,11 +262,38 @@ def main():
     # preprocess log_data
     log_data = preprocess_log_data(log_data)
 
-    process_song_table(song_data, output_data_path)
-    process_artist_table(song_data, output_data_path)
-    process_users_table(log_data, output_data_path)
-    process_time_table(log_data, output_data_path)
-    process_songplays_table(song_data, log_data, output_data_path)
+    # song_data and log_data are used by several tables, cache them so the json files are only read once
+    # num_songs is not used by any table, so it is left out of the cache
+    song_data = song_data.select("song_id", "title", "artist_id", "artist_name", "artist_location", "artist_latitude",
+                                 "artist_longitude", "duration", "year").persist(StorageLevel.MEMORY_AND_DISK)
+    log_data = log_data.persist(StorageLevel.MEMORY_AND_DISK)
+
+    # narrow song dataframe for the songplays join, with one row per song title and artist name
+    song_join = song_data.select("song_id", "title", "artist_id", "artist_name") \
+        .dropDuplicates(["title", "artist_name"]).persist(StorageLevel.MEMORY_AND_DISK)
+
+    # persist is lazy, materialize the caches before the table jobs start so they don't all read the json files
+    song_data.count()
+    log_data.count()
+    song_join.count()
+
+    # the tables are independent of each other, submit them concurrently so their jobs can use idle executors
+    table_jobs = [
+        (process_song_table, (song_data, output_data_path)),
+        (process_artist_table, (song_data, output_data_path)),
+        (process_users_table, (log_data, output_data_path)),
+        (process_time_table, (log_data, output_data_path)),
+        (process_songplays_table, (song_join, log_data, output_data_path))
+    ]
+    try:
+        with ThreadPoolExecutor(max_workers=len(table_jobs)) as executor:
+            futures = [executor.submit(job, *args) for job, args in table_jobs]
+            for future in futures:
+                future.result()
+    finally:
+        song_join.unpersist()
+        song_data.unpersist()
+        log_data.unpersist()
 
 
 if __name__ == "__main__":